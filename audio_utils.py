@@ -0,0 +1,79 @@
+"""
+Audio helpers shared by the desktop GUI and the FastAPI server.
+
+Kept free of tkinter, sounddevice and torch so the headless server can use
+them without a display, PortAudio or a GPU.
+"""
+
+import io, subprocess
+from math import gcd
+
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+
+from gemma_client import MODEL_SAMPLE_RATE
+
+SILENCE_THRESHOLD = 0.01      # |amplitude| below this counts as silence when trimming
+MIN_CLIP_SAMPLES  = MODEL_SAMPLE_RATE // 10   # 100 ms: a few feature-extractor frames
+
+def trim_silence(
+    audio: np.ndarray,
+    threshold: float = SILENCE_THRESHOLD,
+    min_samples: int = MIN_CLIP_SAMPLES,
+) -> np.ndarray:
+    """Drop leading and trailing samples quieter than ``threshold``.
+
+    The kept span is widened to at least ``min_samples`` around the loud part,
+    so a lone click or pop doesn't leave a clip too short to encode.
+    """
+    loud = np.flatnonzero(np.abs(audio) > threshold)
+    if loud.size == 0:
+        return audio
+    start, end = loud[0], loud[-1] + 1
+    missing = min_samples - (end - start)
+    if missing > 0:
+        start = max(start - missing // 2, 0)
+        end = min(start + min_samples, len(audio))
+        start = max(end - min_samples, 0)
+    return audio[start:end]
+
+def to_model_audio(audio: np.ndarray, sample_rate: int) -> np.ndarray:
+    """Downmix to mono float32 in [-1, 1] at MODEL_SAMPLE_RATE."""
+    is_int16 = audio.dtype == np.int16
+    # Downmix straight into float32 (one pass, no float64 temporary), then scale in place
+    if audio.ndim == 2:
+        audio = audio.mean(axis=1, dtype=np.float32)
+    else:
+        audio = audio.astype(np.float32, copy=False)
+    if is_int16:
+        audio *= 1 / 32768.0
+    if sample_rate != MODEL_SAMPLE_RATE:
+        g = gcd(MODEL_SAMPLE_RATE, sample_rate)
+        audio = resample_poly(audio, MODEL_SAMPLE_RATE // g, sample_rate // g)
+    return audio.astype(np.float32, copy=False)
+
+def decode_audio(data: bytes) -> np.ndarray:
+    """Decode an uploaded clip to mono float32 at MODEL_SAMPLE_RATE.
+
+    WAV/FLAC/OGG are read in memory with libsndfile. Anything else, such as the
+    WebM/Opus or MP4 a browser MediaRecorder produces, is decoded by ffmpeg.
+    """
+    try:
+        audio, sample_rate = sf.read(io.BytesIO(data), dtype="float32")
+    except RuntimeError:            # sf.LibsndfileError: format not recognised
+        pass
+    else:
+        return to_model_audio(audio, sample_rate)
+
+    try:
+        proc = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+             "-f", "f32le", "-ac", "1", "-ar", str(MODEL_SAMPLE_RATE), "pipe:1"],
+            input=data, capture_output=True, check=True,
+        )
+    except FileNotFoundError as exc:
+        raise RuntimeError("ffmpeg is required to decode non-WAV audio uploads") from exc
+    except subprocess.CalledProcessError as exc:
+        raise RuntimeError(f"ffmpeg could not decode audio: {exc.stderr.decode().strip()}") from exc
+    return np.frombuffer(proc.stdout, dtype=np.float32)
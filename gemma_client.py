@@ -0,0 +1,136 @@
+"""
+Client side of the Gemma-3n inference worker (see gemma_worker.py).
+
+The GUI and the FastAPI server both talk to one worker process over a
+UNIX-domain socket, so the model is only loaded onto the GPU once.
+
+Wire format, both directions: two big-endian uint32 lengths, a JSON header,
+then an optional binary payload. Audio payloads are mono float32 samples at
+MODEL_SAMPLE_RATE; image payloads are the encoded file bytes.
+"""
+
+import asyncio, json, os, struct, subprocess, sys, tempfile
+
+import numpy as np
+
+SOCKET_PATH       = os.environ.get(
+    "GEMMA3N_SOCKET", os.path.join(tempfile.gettempdir(), "gemma3n_worker.sock")
+)
+WORKER_SCRIPT     = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gemma_worker.py")
+MODEL_SAMPLE_RATE = 16_000    # rate expected by the Gemma-3n audio encoder
+
+# --------------------------------------------------------------------
+# Framing
+# --------------------------------------------------------------------
+
+def write_frame(writer: asyncio.StreamWriter, header: dict, payload: bytes = b""):
+    head = json.dumps(header).encode()
+    writer.write(struct.pack("!II", len(head), len(payload)) + head + payload)
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple[dict, bytes]:
+    head_len, payload_len = struct.unpack("!II", await reader.readexactly(8))
+    header = json.loads(await reader.readexactly(head_len))
+    payload = await reader.readexactly(payload_len)
+    return header, payload
+
+# --------------------------------------------------------------------
+# Worker lifecycle
+# --------------------------------------------------------------------
+
+_spawned = None    # worker process started by this client, if any
+
+async def wait_for_worker(poll_sec: float = 0.5):
+    """Start the worker if nothing is listening, then wait until it accepts connections."""
+    global _spawned
+    spawned = None
+    while True:
+        try:
+            _, writer = await asyncio.open_unix_connection(SOCKET_PATH)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if spawned is None:
+                # Concurrent callers share one spawn instead of racing for the lock
+                if _spawned is None or _spawned.poll() is not None:
+                    _spawned = subprocess.Popen([sys.executable, WORKER_SCRIPT], start_new_session=True)
+                spawned = _spawned
+            elif spawned.poll() not in (None, 0):
+                # Exit code 0 means another instance is already loading the model
+                raise RuntimeError(f"Gemma worker exited with code {spawned.returncode}")
+            await asyncio.sleep(poll_sec)
+            continue
+        writer.close()
+        await writer.wait_closed()
+        return
+
+def stop_worker(timeout_sec: float = 10):
+    """Terminate the worker if this client started it; one started elsewhere keeps running."""
+    global _spawned
+    if _spawned is not None and _spawned.poll() is None:
+        _spawned.terminate()
+        try:
+            _spawned.wait(timeout_sec)
+        except subprocess.TimeoutExpired:
+            _spawned.kill()
+            _spawned.wait()
+    _spawned = None
+
+# --------------------------------------------------------------------
+# Requests
+# --------------------------------------------------------------------
+
+async def stream(template: str, medium, text: str | None = None, *, streaming: bool = True):
+    """Yield reply text from the worker as it is generated.
+
+    ``medium`` is a float32 waveform for audio templates or encoded image
+    bytes (PNG, JPEG, …) for image templates.
+    """
+    header = {"template": template, "text": text, "stream": streaming}
+    if isinstance(medium, np.ndarray):
+        payload = np.ascontiguousarray(medium, dtype=np.float32).tobytes()
+    else:
+        payload = medium
+
+    try:
+        reader, writer = await asyncio.open_unix_connection(SOCKET_PATH)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # The worker died or was stopped since we last saw it: bring it back
+        await wait_for_worker()
+        reader, writer = await asyncio.open_unix_connection(SOCKET_PATH)
+    try:
+        write_frame(writer, header, payload)
+        await writer.drain()
+        while True:
+            reply, _ = await read_frame(reader)
+            if "error" in reply:
+                raise RuntimeError(reply["error"])
+            if reply.get("done"):
+                return
+            yield reply["text"]
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+async def ask(template: str, medium, text: str | None = None) -> str:
+    """Full reply in one piece; the worker may batch it with other requests."""
+    return "".join([piece async for piece in stream(template, medium, text, streaming=False)])
+
+# --------------------------------------------------------------------
+# Reply sanitiser (avoids Unicode glyphs missing in some fonts)
+# --------------------------------------------------------------------
+
+_REPLACE_MAP = {
+    "•": "-",
+    "▪": "-",
+    "●": "-",
+    "◦": "-",
+    "—": "-",
+    "–": "-",
+}
+
+_TRANSLATE = str.maketrans({bad: good for bad, good in _REPLACE_MAP.items() if len(bad) == 1})
+_MULTI_CHAR = {bad: good for bad, good in _REPLACE_MAP.items() if len(bad) > 1}
+
+def sanitize(text: str) -> str:
+    text = text.translate(_TRANSLATE)
+    for bad, good in _MULTI_CHAR.items():
+        text = text.replace(bad, good)
+    return text
@@ -1,78 +1,25 @@
+import asyncio
 import threading
-import tempfile
-import os
+
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, font as tkfont
 
 import numpy as np
 import sounddevice as sd
-from scipy.io.wavfile import write
+from tkthread import TkThread
 
-import torch
-from transformers import AutoProcessor, Gemma3nForConditionalGeneration
+import gemma_client
+from audio_utils import to_model_audio, trim_silence
+from gemma_client import sanitize
 
 # ------------------------------------------------------
 # CONFIGURATION
 # ------------------------------------------------------
-MODEL_ID = "google/gemma-3n-e4b-it"
 INPUT_DEVICE_INDEX = 7          # PortAudio index mapping to hw:1,6
 CHANNELS            = 2
 SAMPLE_RATE         = 48_000
 DURATION_SEC        = 4         # seconds to record per click
-SYSTEM_PROMPT       = (
-    "You are a friendly assistant. Respond in a natural, conversational tone. "
-    "Avoid numbered or bulleted lists; instead write short sentences or paragraphs."
-)
-
-# ------------------------------------------------------
-# AUDIO UTILS
-# ------------------------------------------------------
-
-def record_wav(path: str):
-    """Capture audio from the chosen device and save as 16‑bit WAV."""
-    sd.default.device = (INPUT_DEVICE_INDEX, None)
-    buf = sd.rec(int(DURATION_SEC * SAMPLE_RATE), samplerate=SAMPLE_RATE,
-                 channels=CHANNELS, dtype="int16")
-    sd.wait()
-    write(path, SAMPLE_RATE, buf)
-
-# ------------------------------------------------------
-# MODEL SINGLETON (load once, reuse)
-# ------------------------------------------------------
-
-_model = None
-_processor = None
-_model_lock = threading.Lock()
-
-def get_model_and_processor():
-    global _model, _processor
-    with _model_lock:
-        if _model is None or _processor is None:
-            _processor = AutoProcessor.from_pretrained(MODEL_ID)
-            _model = (
-                Gemma3nForConditionalGeneration
-                .from_pretrained(MODEL_ID, device_map="auto", torch_dtype="auto")
-                .eval()
-            )
-        return _model, _processor
-
-# ------------------------------------------------------
-# SIMPLE SANITISER TO AVOID UNICODE GLYPHS MISSING IN SOME FONTS
-# ------------------------------------------------------
-
-_REPLACE_MAP = {
-    "•": "-",
-    "▪": "-",
-    "●": "-",
-    "◦": "-",
-    "—": "-",
-    "–": "-",
-}
-
-def sanitize(text: str) -> str:
-    for bad, good in _REPLACE_MAP.items():
-        text = text.replace(bad, good)
-    return text
+CAPTURE_TIMEOUT_SEC = DURATION_SEC + 2   # give up if the stream stops delivering
 
 # ------------------------------------------------------
 # GUI
@@ -83,6 +30,8 @@ class GemmaGUI(tk.Tk):
     def __init__(self):
         super().__init__()
         self.title("Gemma‑3n Conversational Audio Demo")
+        # Runs callables on the Tk thread via Tcl's thread::send, without after() polling
+        self.tkt = TkThread(self)
 
         # 4‑K scaling: triple default font sizes
         for f_name in (
@@ -107,11 +56,61 @@ class GemmaGUI(tk.Tk):
         self.columnconfigure(0, weight=1)
         self.rowconfigure(1, weight=1)
 
+        # Capture buffer reused for every recording
+        self._audio_buf = np.empty((DURATION_SEC * SAMPLE_RATE, CHANNELS), dtype=np.int16)
+
+        # Keep the input stream open so a capture doesn't pay PortAudio device setup
+        self._recording = False
+        self._audio_offset = 0
+        self._capture_done = threading.Event()
+        try:
+            self._in_stream = sd.InputStream(
+                device=INPUT_DEVICE_INDEX, samplerate=SAMPLE_RATE, channels=CHANNELS,
+                dtype="int16", blocksize=1024, callback=self._audio_cb,
+            )
+            self._in_stream.start()
+        except sd.PortAudioError as e:
+            # Missing or busy device: keep the window up but never allow recording
+            self._in_stream = None
+            self._append_output(f"Audio input unavailable (device {INPUT_DEVICE_INDEX}): {e}\n")
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
+
         # Disable recording until model is loaded
         self.record_btn.config(state="disabled")
         self._append_output("Loading model … please wait.\n")
         threading.Thread(target=self._load_model_thread, daemon=True).start()
 
+    def _on_close(self):
+        if self._in_stream is not None:
+            self._in_stream.close()
+        self.destroy()
+        gemma_client.stop_worker()
+
+    # --------------------------------------------------
+    # AUDIO CAPTURE (persistent stream, gated by a flag)
+    # --------------------------------------------------
+
+    def _audio_cb(self, indata, frames, time_info, status):
+        if not self._recording:
+            return
+        buf = self._audio_buf
+        n = min(frames, len(buf) - self._audio_offset)
+        buf[self._audio_offset:self._audio_offset + n] = indata[:n]
+        self._audio_offset += n
+        if self._audio_offset >= len(buf):
+            self._recording = False
+            self._capture_done.set()
+
+    def _capture(self) -> np.ndarray:
+        """Fill the capture buffer from the running stream and return it."""
+        self._audio_offset = 0
+        self._capture_done.clear()
+        self._recording = True
+        if not self._capture_done.wait(timeout=CAPTURE_TIMEOUT_SEC):
+            self._recording = False
+            raise RuntimeError("Audio capture timed out; the input stream stopped delivering samples")
+        return self._audio_buf
+
     # --------------------------------------------------
     # THREAD‑SAFE OUTPUT
     # --------------------------------------------------
@@ -121,7 +120,7 @@ class GemmaGUI(tk.Tk):
         def inner():
             self.output.insert(tk.END, txt)
             self.output.see(tk.END)
-        self.output.after(0, inner)
+        self.tkt.nosync(inner)
 
     # --------------------------------------------------
     # MODEL LOADER THREAD
@@ -129,14 +128,16 @@ class GemmaGUI(tk.Tk):
 
     def _load_model_thread(self):
         try:
-            get_model_and_processor()
+            asyncio.run(gemma_client.wait_for_worker())
             self._append_output("Model loaded. You can click Record.\n")
         except Exception as e:
             self._append_output(f"Error loading model: {e}\n")
             messagebox.showerror("Model Load Error", str(e))
         finally:
-            # Enable the record button whether load succeeded or failed
-            self.record_btn.after(0, lambda: self.record_btn.config(state="normal"))
+            # Enable the record button whether load succeeded or failed,
+            # as long as there is an input stream to record from
+            if self._in_stream is not None:
+                self.record_btn.after(0, lambda: self.record_btn.config(state="normal"))
 
     # --------------------------------------------------
     # RECORD → RUN MODEL in background thread
@@ -150,50 +151,17 @@ class GemmaGUI(tk.Tk):
     def _record_and_generate(self):
         try:
             self._append_output(f"Recording… speak now ({DURATION_SEC} s)\n")
-            with tempfile.TemporaryDirectory() as td:
-                wav_path = os.path.join(td, "input.wav")
-                record_wav(wav_path)
-
-                self._append_output("Processing with Gemma … this may take a moment.\n")
-                model, processor = get_model_and_processor()
-
-                messages = [
-                    {
-                        "role": "system",
-                        "content": [
-                            {"type": "text", "text": SYSTEM_PROMPT},
-                        ],
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "Here is my audio message:"},
-                            {"type": "audio", "audio": wav_path},
-                        ],
-                    },
-                ]
-
-                inputs = processor.apply_chat_template(
-                    messages,
-                    add_generation_prompt=True,
-                    tokenize=True,
-                    return_dict=True,
-                    return_tensors="pt",
-                )
-                inputs = inputs.to(model.device, dtype=model.dtype)
-
-                with torch.inference_mode():
-                    generation = model.generate(
-                        **inputs, max_new_tokens=256, disable_compile=True
-                    )
-
-                input_len = inputs["input_ids"].shape[-1]
-                response = processor.decode(
-                    generation[0][input_len:], skip_special_tokens=True
-                )
-                response = sanitize(response)
-
-                self._append_output("\n===== Gemma response =====\n" + response + "\n")
+            audio = to_model_audio(self._capture(), SAMPLE_RATE)
+            audio = trim_silence(audio)
+
+            self._append_output("Processing with Gemma … this may take a moment.\n")
+            async def show_reply():
+                async for piece in gemma_client.stream("voice_chat", audio):
+                    self._append_output(sanitize(piece))
+
+            self._append_output("\n===== Gemma response =====\n")
+            asyncio.run(show_reply())
+            self._append_output("\n")
 
         except Exception as e:
             self._append_output(f"Error: {e}\n")
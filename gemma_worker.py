@@ -0,0 +1,564 @@
+"""
+Gemma-3n inference worker.
+
+Owns the only copy of the model and serves the GUI and the FastAPI server
+over a UNIX-domain socket (protocol in gemma_client.py). Clients start it
+on demand; it can also be run directly with `python gemma_worker.py`.
+"""
+
+import asyncio, fcntl, io, os, threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Keep compiled Inductor/Triton kernels across restarts (must precede torch import)
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.expanduser("~/.cache/gemma3n_inductor"))
+os.environ.setdefault("TRITON_CACHE_DIR", os.path.expanduser("~/.cache/gemma3n_triton"))
+
+import numpy as np
+import torch
+import torch._inductor.config
+from torch import nn
+from PIL import Image
+from transformers import (
+    AsyncTextIteratorStreamer, AutoProcessor, BatchFeature, BitsAndBytesConfig, CompileConfig,
+    Gemma3nForConditionalGeneration, StaticCache, StoppingCriteria, StoppingCriteriaList,
+)
+
+from gemma_client import MODEL_SAMPLE_RATE, SOCKET_PATH, read_frame, write_frame
+
+# Reuse compiled FX graphs across runs and keep Triton kernel names readable
+torch._inductor.config.fx_graph_cache = True
+torch._inductor.config.triton.unique_kernel_names = True
+
+# TF32 matmuls and fused SDPA attention kernels
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cuda.enable_flash_sdp(True)
+torch.backends.cuda.enable_mem_efficient_sdp(True)
+
+# ------------------------------------------------------
+# CONFIGURATION
+# ------------------------------------------------------
+MODEL_ID = "google/gemma-3n-e4b-it"
+MAX_NEW_TOKENS      = 256
+MAX_PROMPT_TOKENS   = 1024      # prompt budget of the preallocated KV cache
+STOP_AT_PARAGRAPH   = False     # end a reply at its first blank line …
+PARAGRAPH_MIN_TOKENS = 20       # … once at least this many tokens were generated
+COMPILE_MODEL       = True      # torch.compile the decode step (static KV cache)
+# bf16 on Ampere+; elsewhere let transformers pick from the checkpoint
+TORCH_DTYPE         = (
+    torch.bfloat16
+    if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+    else "auto"
+)
+LOAD_IN_4BIT        = True      # nf4 weights for the text decoder (needs CUDA + bitsandbytes)
+FUSE_QKV            = False     # one q/k/v matmul per attention block (needs LOAD_IN_4BIT = False)
+MAX_BATCH_SIZE      = 8         # requests folded into one generate call
+BATCH_WINDOW_SEC    = 0.05      # how long to wait for more requests to join a batch
+SYSTEM_PROMPT       = (
+    "You are a friendly assistant. Respond in a natural, conversational tone. "
+    "Avoid numbered or bulleted lists; instead write short sentences or paragraphs."
+)
+
+# ------------------------------------------------------
+# MODEL SINGLETON (load once, reuse)
+# ------------------------------------------------------
+
+_model = None
+_processor = None
+_static_cache = None            # reused by every single-request generate
+_model_lock = threading.Lock()
+
+def quantization_config():
+    """4-bit nf4 weights for the decoder; audio/vision towers stay in full precision."""
+    if not (LOAD_IN_4BIT and torch.cuda.is_available()):
+        return None
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_compute_dtype=TORCH_DTYPE if TORCH_DTYPE != "auto" else torch.float16,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_use_double_quant=True,
+        llm_int8_skip_modules=[
+            "audio_tower", "vision_tower", "embed_audio", "embed_vision", "lm_head",
+        ],
+    )
+
+def get_model_and_processor():
+    global _model, _processor, _static_cache
+    with _model_lock:
+        if _model is None or _processor is None:
+            _processor = AutoProcessor.from_pretrained(MODEL_ID)
+            _model = (
+                Gemma3nForConditionalGeneration
+                .from_pretrained(
+                    MODEL_ID,
+                    device_map="auto",
+                    torch_dtype=TORCH_DTYPE,
+                    attn_implementation="sdpa",
+                    quantization_config=quantization_config(),
+                )
+                .eval()
+            )
+            # NHWC lets the vision tower's convolutions use cuDNN's fast path
+            _model.model.vision_tower.to(memory_format=torch.channels_last)
+            if FUSE_QKV and fuse_qkv(_model) == 0:
+                raise RuntimeError(
+                    "FUSE_QKV is set but no attention layer could be fused; "
+                    "it needs plain nn.Linear projections (set LOAD_IN_4BIT = False)"
+                )
+            if COMPILE_MODEL:
+                # generate() compiles only the fixed-shape decode step; the media
+                # prefill stays eager (its placeholder masks are data-dependent).
+                # It skips compilation for bitsandbytes weights (LOAD_IN_4BIT).
+                _model.generation_config.cache_implementation = "static"
+                _model.generation_config.max_new_tokens = MAX_NEW_TOKENS
+                _model.generation_config.compile_config = CompileConfig(
+                    fullgraph=True, mode="reduce-overhead"
+                )
+            # transformers 4.56 (pinned in the README): StaticCache gives the
+            # sliding-window layers their own ring buffers and skips the
+            # KV-shared ones; layers are allocated lazily unless we do it here
+            text_config = _model.config.get_text_config()
+            _static_cache = StaticCache(
+                config=text_config,
+                max_cache_len=MAX_PROMPT_TOKENS + MAX_NEW_TOKENS,
+            )
+            _static_cache.early_initialization(
+                batch_size=1,
+                num_heads=text_config.num_key_value_heads,
+                head_dim=text_config.head_dim,
+                dtype=_model.dtype,
+                device=_model.device,
+            )
+        return _model, _processor
+
+# ------------------------------------------------------
+# FUSED Q/K/V PROJECTIONS (one GEMV per attention block at decode)
+# ------------------------------------------------------
+
+class _QKVSlice(nn.Module):
+    """Stands in for q/k/v_proj: receives the fused projection and returns its part."""
+
+    def __init__(self, start: int, size: int):
+        super().__init__()
+        self.start = start
+        self.size = size
+
+    def forward(self, qkv):
+        return qkv.narrow(-1, self.start, self.size)
+
+def _fused_forward(forward, qkv_proj):
+    def fused_forward(hidden_states, *args, **kwargs):
+        return forward(qkv_proj(hidden_states), *args, **kwargs)
+    return fused_forward
+
+@torch.no_grad()
+def fuse_qkv(model) -> int:
+    """Merge each decoder layer's q/k/v projections into a single linear.
+
+    The attention forward itself is untouched: it is fed the fused output and
+    q/k/v_proj become slices of it. Layers that reuse another layer's KV cache,
+    or whose projections are not plain nn.Linear (e.g. 4-bit), are skipped.
+    """
+    fused = 0
+    for layer in model.model.language_model.layers:
+        attn = layer.self_attn
+        projs = (attn.q_proj, attn.k_proj, attn.v_proj)
+        if getattr(attn, "is_kv_shared_layer", False) or any(type(p) is not nn.Linear for p in projs):
+            continue
+
+        weight = projs[0].weight
+        qkv_proj = nn.Linear(
+            weight.shape[1], sum(p.out_features for p in projs),
+            bias=projs[0].bias is not None, device=weight.device, dtype=weight.dtype,
+        )
+        qkv_proj.weight.copy_(torch.cat([p.weight for p in projs]))
+        if qkv_proj.bias is not None:
+            qkv_proj.bias.copy_(torch.cat([p.bias for p in projs]))
+
+        # Check the fused weights against the originals before swapping them in
+        x = torch.randn(2, weight.shape[1], device=weight.device, dtype=weight.dtype)
+        torch.testing.assert_close(qkv_proj(x), torch.cat([p(x) for p in projs], dim=-1))
+
+        start = 0
+        slices = []
+        for p in projs:
+            slices.append(_QKVSlice(start, p.out_features))
+            start += p.out_features
+        attn.qkv_proj = qkv_proj
+        attn.q_proj, attn.k_proj, attn.v_proj = slices
+        attn.forward = _fused_forward(attn.forward, qkv_proj)
+        fused += 1
+    return fused
+
+# ------------------------------------------------------
+# GENERATION SETTINGS (stop as soon as the reply is complete)
+# ------------------------------------------------------
+
+_paragraph_break_ids = {}        # device -> ids of tokens whose text contains a blank line
+
+def paragraph_break_ids(tokenizer, device) -> torch.Tensor:
+    if device not in _paragraph_break_ids:
+        ids = [
+            i for tok, i in tokenizer.get_vocab().items()
+            if "\n" in tok and "\n\n" in tokenizer.convert_tokens_to_string([tok])
+        ]
+        _paragraph_break_ids[device] = torch.tensor(ids, dtype=torch.long, device=device)
+    return _paragraph_break_ids[device]
+
+class ParagraphStop(StoppingCriteria):
+    """Finish a row once it emits a blank line after ``min_new_tokens`` tokens.
+
+    Only the newest token is compared, against a precomputed id set on the
+    GPU, so the check doesn't force a device sync on every decode step.
+    """
+
+    def __init__(self, tokenizer, prompt_len: int, min_new_tokens: int = PARAGRAPH_MIN_TOKENS):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.min_new_tokens = min_new_tokens
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if input_ids.shape[-1] - self.prompt_len < self.min_new_tokens:
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        return torch.isin(
+            input_ids[:, -1], paragraph_break_ids(self.tokenizer, input_ids.device)
+        )
+
+def generation_kwargs(processor, prompt_len: int, max_new_tokens: int = MAX_NEW_TOKENS) -> dict:
+    """Keyword arguments shared by every ``model.generate`` call."""
+    tokenizer = processor.tokenizer
+    kwargs = dict(
+        max_new_tokens=max_new_tokens,
+        eos_token_id=[tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<end_of_turn>")],
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    if STOP_AT_PARAGRAPH:
+        kwargs["stopping_criteria"] = StoppingCriteriaList(
+            [ParagraphStop(tokenizer, prompt_len)]
+        )
+    return kwargs
+
+# ------------------------------------------------------
+# HOST → DEVICE COPIES (pinned memory on a side stream)
+# ------------------------------------------------------
+
+_copy_stream = None
+
+def to_device(inputs: BatchFeature, model) -> BatchFeature:
+    """Move CPU tensors to the model's device, casting floats to its dtype."""
+    global _copy_stream
+    if model.device.type != "cuda":
+        return inputs.to(model.device, dtype=model.dtype)
+    if _copy_stream is None:
+        _copy_stream = torch.cuda.Stream(device=model.device)
+
+    main_stream = torch.cuda.current_stream(model.device)
+    with torch.cuda.stream(_copy_stream):
+        for key, value in inputs.items():
+            if not torch.is_tensor(value) or value.device == model.device:
+                continue
+            value = value.pin_memory().to(model.device, non_blocking=True)
+            if value.is_floating_point():
+                value = value.to(model.dtype)
+            value.record_stream(main_stream)
+            inputs[key] = value
+    main_stream.wait_stream(_copy_stream)
+    return inputs
+
+# ------------------------------------------------------
+# PROMPT TEMPLATES (tokenise the static chat scaffolding once)
+# ------------------------------------------------------
+
+PROMPT_SLOT = "<<prompt>>"      # text item filled in per request
+
+class PromptTemplate:
+    """Chat messages with a single audio or image item, tokenised once.
+
+    The media item's value is ignored; an optional text item equal to
+    PROMPT_SLOT is filled per request. Only the media feature extractor
+    and the slot text run per call.
+    """
+
+    def __init__(self, model, processor, messages):
+        self.processor = processor
+        self.kind = next(
+            item["type"] for m in messages for item in m["content"]
+            if item["type"] in ("audio", "image")
+        )
+        self.device = model.device
+
+        rendered = processor.apply_chat_template(
+            messages, add_generation_prompt=True, tokenize=False
+        )
+        head, _, tail = rendered.partition(PROMPT_SLOT)
+        if self.kind == "audio":
+            placeholder = {"audio": [np.zeros(MODEL_SAMPLE_RATE, dtype=np.float32)]}
+        else:
+            placeholder = {"images": [Image.new("RGB", (64, 64))]}
+        self.prefix_ids = processor(
+            text=head, add_special_tokens=False, return_tensors="pt", **placeholder
+        )["input_ids"][0].to(self.device)
+        self.suffix_ids = self._tokenize(tail)
+
+    def _tokenize(self, text: str) -> torch.Tensor:
+        return self.processor.tokenizer(
+            text, add_special_tokens=False, return_tensors="pt"
+        )["input_ids"][0].to(self.device)
+
+    def _features(self, media: list) -> dict:
+        if self.kind == "audio":
+            return self.processor.feature_extractor(media, return_tensors="pt")
+        return self.processor.image_processor(media, return_tensors="pt")
+
+    def encode_batch(self, requests: list) -> BatchFeature:
+        """Left-padded batch for a list of ``(medium, text)`` pairs."""
+        rows = []
+        for _, text in requests:
+            parts = [self.prefix_ids]
+            if text is not None:
+                parts.append(self._tokenize(text))
+            parts.append(self.suffix_ids)
+            rows.append(torch.cat(parts))
+
+        width = max(len(row) for row in rows)
+        input_ids = torch.full(
+            (len(rows), width), self.processor.tokenizer.pad_token_id,
+            dtype=torch.long, device=self.device,
+        )
+        attention_mask = torch.zeros_like(input_ids)
+        for i, row in enumerate(rows):
+            input_ids[i, width - len(row):] = row
+            attention_mask[i, width - len(row):] = 1
+        return BatchFeature({
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            **self._features([medium for medium, _ in requests]),
+        })
+
+def build_templates(model, processor) -> dict:
+    """Named prompt templates clients refer to in their requests."""
+    friendly = {
+        "role": "system",
+        "content": [{"type": "text", "text": "You are a friendly assistant."}],
+    }
+    return {
+        # Desktop GUI (gemma_record_gui.py)
+        "voice_chat": PromptTemplate(model, processor, [
+            {
+                "role": "system",
+                "content": [
+                    {"type": "text", "text": SYSTEM_PROMPT},
+                ],
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "Here is my audio message:"},
+                    {"type": "audio", "audio": None},
+                ],
+            },
+        ]),
+        # FastAPI /ask
+        "audio": PromptTemplate(model, processor, [
+            friendly,
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "Here is my audio message:"},
+                    {"type": "audio", "audio": None},
+                ],
+            },
+        ]),
+        # FastAPI /ask_image
+        "image": PromptTemplate(model, processor, [
+            friendly,
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": None},
+                    {"type": "text", "text": PROMPT_SLOT},
+                ],
+            },
+        ]),
+    }
+
+# ------------------------------------------------------
+# MICRO-BATCHING: concurrent requests share a single generate call
+# ------------------------------------------------------
+
+@torch.inference_mode()
+def generate_batch(
+    template: PromptTemplate, requests: list, streamer=None, max_new_tokens: int = MAX_NEW_TOKENS,
+) -> list[str]:
+    model, processor = get_model_and_processor()
+    inputs = to_device(template.encode_batch(requests), model)
+    if "pixel_values" in inputs:
+        inputs["pixel_values"] = inputs["pixel_values"].to(memory_format=torch.channels_last)
+    prompt_len = inputs["input_ids"].shape[-1]
+
+    # Single requests reuse the preallocated cache; batches get a fresh one
+    cache_kwargs = {}
+    if len(requests) == 1 and prompt_len <= MAX_PROMPT_TOKENS:
+        _static_cache.reset()
+        cache_kwargs = dict(past_key_values=_static_cache, cache_implementation=None)
+
+    out = model.generate(
+        **inputs,
+        streamer=streamer,
+        **cache_kwargs,
+        **generation_kwargs(processor, prompt_len, max_new_tokens),
+    )
+
+    return processor.batch_decode(out[:, prompt_len:], skip_special_tokens=True)
+
+# Every generate (warmup included) runs on this one thread: reduce-overhead
+# CUDA graphs are recorded per thread, and it serialises access to the GPU.
+# Grad mode is thread-local, so it is switched off in that thread's initializer.
+gpu_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="gemma-gpu",
+    initializer=torch.set_grad_enabled, initargs=(False,),
+)
+
+def warmup(templates: dict):
+    """Run a batch-1 audio and image request so the decode step compiles before serving.
+
+    Batched requests use a differently shaped cache and compile on first use.
+    """
+    silence = np.zeros(MODEL_SAMPLE_RATE // 10, dtype=np.float32)
+    generate_batch(templates["voice_chat"], [(silence, None)], max_new_tokens=2)
+    blank = Image.new("RGB", (64, 64))
+    generate_batch(templates["image"], [(blank, "Describe this image.")], max_new_tokens=2)
+
+class MicroBatcher:
+    """Queue requests for a short window and run each template's batch at once.
+
+    Streamed requests run on their own, since a streamer follows one row.
+    All generate calls go through run(), so the GPU is never shared.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    async def submit(self, template: PromptTemplate, medium, text: str | None = None) -> str:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((template, medium, text, None, future))
+        return await future
+
+    async def stream(self, template: PromptTemplate, medium, text: str | None = None):
+        _, processor = get_model_and_processor()
+        streamer = AsyncTextIteratorStreamer(
+            processor.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((template, medium, text, streamer, future))
+        async for piece in streamer:
+            yield piece
+        await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + BATCH_WINDOW_SEC
+            while len(pending) < MAX_BATCH_SIZE:
+                try:
+                    pending.append(await asyncio.wait_for(
+                        self.queue.get(), max(deadline - loop.time(), 0)
+                    ))
+                except asyncio.TimeoutError:
+                    break
+
+            jobs = {}
+            for template, medium, text, streamer, future in pending:
+                key = template if streamer is None else streamer
+                jobs.setdefault(key, []).append((template, medium, text, streamer, future))
+            for items in jobs.values():
+                template, _, _, streamer, _ = items[0]
+                requests = [(medium, text) for _, medium, text, _, _ in items]
+                try:
+                    replies = await loop.run_in_executor(
+                        gpu_executor, generate_batch, template, requests, streamer
+                    )
+                except Exception as exc:
+                    if streamer is not None:
+                        streamer.end()
+                    for *_, future in items:
+                        if not future.done():
+                            future.set_exception(exc)
+                    continue
+                for (*_, future), reply in zip(items, replies):
+                    if not future.done():
+                        future.set_result(reply)
+
+# ------------------------------------------------------
+# SOCKET SERVER
+# ------------------------------------------------------
+
+def _decode_image(data: bytes) -> Image.Image:
+    return Image.open(io.BytesIO(data)).convert("RGB")
+
+async def handle(templates: dict, batcher: MicroBatcher, reader, writer):
+    try:
+        request, payload = await read_frame(reader)
+        template = templates[request["template"]]
+        if template.kind == "audio":
+            medium = np.frombuffer(payload, dtype=np.float32)
+        else:
+            # Full-size JPEG/PNG decoding would stall the batch window and other streams
+            medium = await asyncio.to_thread(_decode_image, payload)
+
+        if request["stream"]:
+            async for piece in batcher.stream(template, medium, request["text"]):
+                write_frame(writer, {"text": piece})
+                await writer.drain()
+        else:
+            write_frame(writer, {"text": await batcher.submit(template, medium, request["text"])})
+        write_frame(writer, {"done": True})
+    except asyncio.IncompleteReadError:
+        pass  # client went away (e.g. wait_for_worker probing)
+    except Exception as exc:
+        write_frame(writer, {"error": str(exc)})
+    finally:
+        writer.close()
+
+async def serve():
+    model, processor = get_model_and_processor()
+    templates = build_templates(model, processor)
+    if COMPILE_MODEL:
+        # Clients see the socket only after this, so nobody waits on a cold compile
+        try:
+            await asyncio.get_running_loop().run_in_executor(gpu_executor, warmup, templates)
+        except Exception as exc:
+            print(f"Warmup failed, serving without torch.compile: {exc!r}", flush=True)
+            model.generation_config.disable_compile = True
+    batcher = MicroBatcher()
+
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+    old_umask = os.umask(0o177)     # socket is owner-only
+    try:
+        server = await asyncio.start_unix_server(
+            partial(handle, templates, batcher), path=SOCKET_PATH
+        )
+    finally:
+        os.umask(old_umask)
+
+    print(f"Gemma worker listening on {SOCKET_PATH}", flush=True)
+    async with server:
+        await asyncio.gather(server.serve_forever(), batcher.run())
+
+# ------------------------------------------------------
+# MAIN
+# ------------------------------------------------------
+
+
+if __name__ == "__main__":
+    # Only one worker per socket: a second copy would load the model again
+    lock = open(SOCKET_PATH + ".lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("Gemma worker already running.", flush=True)
+    else:
+        asyncio.run(serve())